@@ -1,11 +1,169 @@
 import functions_framework
+from google.api_core.exceptions import from_http_response
 from google.cloud import storage
-import json
-from flask import jsonify
+import msgspec
+import orjson
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response
+from requests.adapters import HTTPAdapter
 
 # Initialize Cloud Storage client
 storage_client = storage.Client()
 BUCKET_NAME = 'myformsnapper-embeddings'
+bucket = storage_client.bucket(BUCKET_NAME)
+
+# Size the connection pool for the concurrent transfers; requests keeps only
+# 10 connections per host by default
+HTTP_POOL_SIZE = 32
+storage_client._http.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
+# Set once the bucket is known to exist; it is never deleted while deployed,
+# so warm instances skip the existence check after the first request
+bucket_exists = False
+bucket_exists_lock = threading.Lock()
+
+
+def check_bucket_exists(bucket):
+    """
+    Return whether the bucket exists, checking with Cloud Storage only until
+    it has been seen once on this instance
+    """
+    global bucket_exists
+
+    if not bucket_exists:
+        with bucket_exists_lock:
+            if not bucket_exists:
+                bucket_exists = bucket.exists()
+
+    return bucket_exists
+
+
+# Open a pooled HTTPS connection and fetch an access token while the instance
+# starts, so the first request does not pay for the TLS handshake
+try:
+    check_bucket_exists(bucket)
+except Exception as e:
+    print(f'⚠️  Storage warm-up failed: {str(e)}')
+
+
+# Files save_embeddings writes for each document, so a document can be
+# deleted without listing it
+DOCUMENT_FILES = ('chunks.json', 'embeddings.bin', 'metadata.json')
+
+
+def delete_document(prefix):
+    """
+    Delete a document's known files in a single JSON batch request
+
+    Returns the names of the files that existed; a 404 only means the
+    document does not have that file, any other failure is raised
+    """
+    blobs = [bucket.blob(prefix + file_name) for file_name in DOCUMENT_FILES]
+
+    # Collect each delete's status instead of raising on the 404s for files
+    # the document does not have
+    batch = storage_client.batch(raise_exception=False)
+    with batch:
+        for blob in blobs:
+            blob.delete()
+
+    # google-cloud-storage 2.10 has no public accessor for the sub-responses
+    # of a batch used as a context manager, so they are read from _responses
+    deleted = []
+    for blob, response in zip(blobs, batch._responses):
+        if 200 <= response.status_code < 300:
+            deleted.append(blob.name)
+        elif response.status_code != 404:
+            raise from_http_response(response)
+
+    for name in deleted:
+        print(f'   ✓ Deleted: {name}')
+
+    return deleted
+
+
+# Cloud Storage accepts at most 100 calls per batch request
+DELETE_BATCH_SIZE = 100
+
+# Blobs per listing page; each page is deleted while the next one is fetched
+LIST_PAGE_SIZE = 1000
+
+# Deleting only needs blob names, so listings ask for a partial response
+LIST_FIELDS = 'items(name),nextPageToken'
+
+# Batch requests in flight at once; the pool is reused across warm invocations
+DELETE_MAX_WORKERS = 32
+executor = ThreadPoolExecutor(max_workers=DELETE_MAX_WORKERS)
+
+
+def delete_batch(blobs):
+    """
+    Delete up to DELETE_BATCH_SIZE blobs in a single JSON batch request
+    """
+    # The client keeps its batch stack per thread, so workers can batch concurrently
+    with storage_client.batch():
+        for blob in blobs:
+            blob.delete()
+
+
+def delete_blob_pages(pages):
+    """
+    Delete every blob of a paged listing using the Cloud Storage JSON batch
+    API, with up to DELETE_MAX_WORKERS batches of DELETE_BATCH_SIZE deletes
+    in flight while the next page is still being listed
+
+    Returns the names of the deleted blobs
+    """
+    in_flight = threading.BoundedSemaphore(DELETE_MAX_WORKERS)
+    futures = []
+    names = []
+
+    def run_batch(blobs):
+        try:
+            delete_batch(blobs)
+        finally:
+            in_flight.release()
+
+    for page in pages:
+        blobs = list(page)
+        for start in range(0, len(blobs), DELETE_BATCH_SIZE):
+            # Block until a worker frees up to bound the number of pending batches
+            in_flight.acquire()
+            futures.append(executor.submit(run_batch, blobs[start:start + DELETE_BATCH_SIZE]))
+        names.extend(blob.name for blob in blobs)
+
+    for future in futures:
+        future.result()
+
+    for name in names:
+        print(f'   ✓ Deleted: {name}')
+
+    return names
+
+
+class DeleteResponse(msgspec.Struct, rename='camel', kw_only=True):
+    success: bool = True
+    documents_deleted: int
+    message: str
+
+
+class ErrorResponse(msgspec.Struct, kw_only=True):
+    success: bool = False
+    error: str
+
+
+# Response structs have a fixed shape, so one encoder is built up front and
+# reused instead of walking a fresh dict on every request
+json_encoder = msgspec.json.Encoder()
+
+
+def json_response(payload):
+    """
+    Build a JSON response from one of the response structs
+    """
+    return Response(json_encoder.encode(payload), mimetype='application/json')
+
 
 @functions_framework.http
 def delete_embeddings(request):
@@ -41,27 +199,25 @@ def delete_embeddings(request):
     }
 
     try:
-        request_json = request.get_json(silent=True)
+        # Parse the raw body with orjson rather than Flask's stdlib-based get_json
+        try:
+            request_json = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            request_json = None
 
-        if not request_json:
-            return (jsonify({'success': False, 'error': 'No JSON data provided'}), 400, headers)
+        if not request_json or not isinstance(request_json, dict):
+            return (json_response(ErrorResponse(error='No JSON data provided')), 400, headers)
 
         # Validate required fields
         if 'userId' not in request_json:
-            return (jsonify({'success': False, 'error': 'Missing required field: userId'}), 400, headers)
+            return (json_response(ErrorResponse(error='Missing required field: userId')), 400, headers)
 
         user_id = request_json['userId']
         document_id = request_json.get('documentId')  # Optional
 
-        bucket = storage_client.bucket(BUCKET_NAME)
-
-        if not bucket.exists():
+        if not check_bucket_exists(bucket):
             print(f'⚠️  Bucket {BUCKET_NAME} does not exist')
-            return (jsonify({
-                'success': True,
-                'documentsDeleted': 0,
-                'message': 'No documents to delete'
-            }), 200, headers)
+            return (json_response(DeleteResponse(documents_deleted=0, message='No documents to delete')), 200, headers)
 
         deleted_count = 0
 
@@ -69,18 +225,13 @@ def delete_embeddings(request):
             # Delete specific document
             print(f'🗑️  Deleting document {document_id} for user {user_id}')
 
+            # No listing needed: the file names are fixed, and the document
+            # exists if any of them did
             prefix = f'users/{user_id}/documents/{document_id}/'
-            blobs = list(bucket.list_blobs(prefix=prefix))
-
-            if not blobs:
-                return (jsonify({
-                    'success': False,
-                    'error': f'Document {document_id} not found'
-                }), 404, headers)
+            deleted = delete_document(prefix)
 
-            for blob in blobs:
-                blob.delete()
-                print(f'   ✓ Deleted: {blob.name}')
+            if not deleted:
+                return (json_response(ErrorResponse(error=f'Document {document_id} not found')), 404, headers)
 
             deleted_count = 1
             message = f'Successfully deleted document {document_id}'
@@ -89,36 +240,27 @@ def delete_embeddings(request):
             # Delete all documents for user
             print(f'🗑️  Deleting all documents for user {user_id}')
 
+            # Deletes start as soon as the first page of the listing arrives
             prefix = f'users/{user_id}/documents/'
-            blobs = list(bucket.list_blobs(prefix=prefix))
+            deleted = delete_blob_pages(bucket.list_blobs(prefix=prefix, page_size=LIST_PAGE_SIZE, fields=LIST_FIELDS).pages)
 
-            # Group by document
+            # Count documents by the path segment after the known prefix, only
+            # for names of the form {documentId}/{file} so placeholder or stray
+            # objects directly under the prefix are not counted
+            prefix_len = len(prefix)
             documents = set()
-            for blob in blobs:
-                parts = blob.name.split('/')
-                if len(parts) >= 5:
-                    doc_id = parts[3]
+            for name in deleted:
+                doc_id, _, file_type = name[prefix_len:].partition('/')
+                if file_type:
                     documents.add(doc_id)
 
-            # Delete all blobs
-            for blob in blobs:
-                blob.delete()
-                print(f'   ✓ Deleted: {blob.name}')
-
             deleted_count = len(documents)
             message = f'Successfully deleted {deleted_count} documents for user {user_id}'
 
         print(f'✅ {message}')
 
-        return (jsonify({
-            'success': True,
-            'documentsDeleted': deleted_count,
-            'message': message
-        }), 200, headers)
+        return (json_response(DeleteResponse(documents_deleted=deleted_count, message=message)), 200, headers)
 
     except Exception as e:
         print(f'❌ Error deleting embeddings: {str(e)}')
-        return (jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500, headers)
+        return (json_response(ErrorResponse(error=str(e))), 500, headers)
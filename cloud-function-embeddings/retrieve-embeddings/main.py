@@ -1,11 +1,276 @@
 import functions_framework
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
-import json
-from flask import jsonify
+import gzip
+import io
+import msgspec
+import numpy as np
+import orjson
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response
+from requests.adapters import HTTPAdapter
 
 # Initialize Cloud Storage client
 storage_client = storage.Client()
 BUCKET_NAME = 'myformsnapper-embeddings'
+bucket = storage_client.bucket(BUCKET_NAME)
+
+# Size the connection pool for the concurrent transfers; requests keeps only
+# 10 connections per host by default
+HTTP_POOL_SIZE = 32
+storage_client._http.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
+# Set once the bucket is known to exist; it is never deleted while deployed,
+# so warm instances skip the existence check after the first request
+bucket_exists = False
+bucket_exists_lock = threading.Lock()
+
+
+def check_bucket_exists(bucket):
+    """
+    Return whether the bucket exists, checking with Cloud Storage only until
+    it has been seen once on this instance
+    """
+    global bucket_exists
+
+    if not bucket_exists:
+        with bucket_exists_lock:
+            if not bucket_exists:
+                bucket_exists = bucket.exists()
+
+    return bucket_exists
+
+
+# Open a pooled HTTPS connection and fetch an access token while the instance
+# starts, so the first request does not pay for the TLS handshake
+try:
+    check_bucket_exists(bucket)
+except Exception as e:
+    print(f'⚠️  Storage warm-up failed: {str(e)}')
+
+
+# One pool serves every transfer on the instance, range reads and whole-blob
+# downloads alike, so in-flight requests never outnumber the pooled connections
+executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE)
+
+# Blobs larger than this are fetched as concurrent range reads of DOWNLOAD_CHUNK_SIZE
+LARGE_BLOB_SIZE = 8 * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Listings only return what the downloads need: size and generation for range
+# reads, contentEncoding to decompress them, instead of the full object resource
+LIST_FIELDS = 'items(name,size,generation,contentEncoding),nextPageToken'
+
+# Files save_embeddings writes for each document
+DOCUMENT_FILES = ('chunks.json', 'embeddings.bin', 'metadata.json')
+
+# embeddings.bin starts with an 8-byte header: format version, 3 padding bytes, dimension
+EMBEDDINGS_HEADER = struct.Struct('<B3xI')
+EMBEDDINGS_FORMAT_INT8 = 1
+
+
+def is_large_blob(blob):
+    """
+    Check whether a blob was listed with a size above LARGE_BLOB_SIZE
+    """
+    return blob.size is not None and blob.size > LARGE_BLOB_SIZE
+
+
+def download_blob(blob):
+    """
+    Download a whole blob, or return None if it does not exist
+    """
+    buffer = io.BytesIO()
+    try:
+        blob.download_to_file(buffer)
+    except NotFound:
+        return None
+
+    # Hand out the buffer's memory directly instead of copying it to bytes
+    return buffer.getbuffer()
+
+
+def download_range(blob, start, end):
+    """
+    Download the stored bytes start..end (inclusive) of a blob
+    """
+    buffer = io.BytesIO()
+    # Ranges address the stored bytes, so gzip-encoded blobs are fetched raw.
+    # The listed generation is part of the request, so every range reads the
+    # same version of the object
+    blob.download_to_file(buffer, start=start, end=end, raw_download=True)
+    return buffer.getbuffer()
+
+
+def download_blobs(blobs):
+    """
+    Download blobs concurrently on the shared executor
+
+    Returns the contents in the same order as blobs, with None for blobs that
+    do not exist. Large blobs are split into range reads and reassembled,
+    decompressing gzip-encoded ones once complete; smaller ones are
+    downloaded whole, and the client library decompresses them on the way in.
+    """
+    # Every range and every whole blob is its own task in one flat queue, so
+    # the request waits for the slowest transfer rather than their sum
+    pending = []
+    for blob in blobs:
+        if is_large_blob(blob):
+            parts = [
+                executor.submit(download_range, blob, start, min(start + DOWNLOAD_CHUNK_SIZE, blob.size) - 1)
+                for start in range(0, blob.size, DOWNLOAD_CHUNK_SIZE)
+            ]
+        else:
+            parts = [executor.submit(download_blob, blob)]
+        pending.append((blob, parts))
+
+    contents = []
+    for blob, parts in pending:
+        if not is_large_blob(blob):
+            contents.append(parts[0].result())
+            continue
+
+        content = b''.join([part.result() for part in parts])
+        if blob.content_encoding == 'gzip':
+            content = gzip.decompress(content)
+        contents.append(content)
+
+    return contents
+
+
+def decode_embeddings(files, rows):
+    """
+    Return the embedding matrix stored next to a document's chunks, or None
+    when the vectors are still inline in chunks.json
+
+    Raises ValueError when the stored matrix does not hold exactly one row
+    per chunk, e.g. after a partially failed re-save
+    """
+    if 'embeddings.bin' in files:
+        data = files['embeddings.bin']
+        if len(data) < EMBEDDINGS_HEADER.size:
+            raise ValueError('embeddings.bin is truncated')
+
+        version, dimension = EMBEDDINGS_HEADER.unpack_from(data)
+
+        if version != EMBEDDINGS_FORMAT_INT8:
+            raise ValueError(f'Unsupported embeddings format: {version}')
+
+        # int8 rows with a float32 scale per row
+        offset = EMBEDDINGS_HEADER.size
+        if len(data) != offset + rows * 4 + rows * dimension:
+            raise ValueError(f'embeddings.bin does not hold {rows} rows of dimension {dimension}')
+
+        scales = np.frombuffer(data, dtype='<f4', count=rows, offset=offset)
+        quantized = np.frombuffer(data, dtype=np.int8, count=rows * dimension, offset=offset + scales.nbytes)
+        return quantized.reshape(rows, dimension).astype(np.float32) * scales[:, None]
+
+    return None
+
+
+def load_documents(documents, skip_corrupt=True):
+    """
+    Download and decode documents grouped as {documentId: {fileName: blob}}
+
+    Returns a (chunks, metadata) pair per document in the same order, with
+    None for files that do not exist. A document whose embeddings do not
+    match its chunks is returned as (None, None) and logged, so it cannot
+    fail the whole request, or raises ValueError when skip_corrupt is False.
+    Metadata is left as the stored JSON bytes, ready to be spliced into the
+    response.
+    """
+    names = [(doc_id, file_name) for doc_id, files in documents.items() for file_name in files]
+    contents = download_blobs([documents[doc_id][file_name] for doc_id, file_name in names])
+
+    downloaded = {doc_id: {} for doc_id in documents}
+    for (doc_id, file_name), content in zip(names, contents):
+        if content is not None:
+            downloaded[doc_id][file_name] = content
+
+    loaded = []
+    for doc_id, files in downloaded.items():
+        chunks = orjson.loads(files['chunks.json']) if 'chunks.json' in files else None
+        metadata = files.get('metadata.json')
+
+        try:
+            embeddings = decode_embeddings(files, len(chunks)) if chunks else None
+        except ValueError as e:
+            if not skip_corrupt:
+                raise ValueError(f'Document {doc_id} is corrupt: {str(e)}') from e
+
+            print(f'⚠️  Skipping document {doc_id}: {str(e)}')
+            loaded.append((None, None))
+            continue
+
+        # Documents saved before embeddings.bin keep their vectors inline
+        if embeddings is not None:
+            for chunk, embedding in zip(chunks, embeddings):
+                chunk['embedding'] = embedding
+
+        loaded.append((chunks, metadata))
+
+    return loaded
+
+
+class EmptyRetrieveResponse(msgspec.Struct, rename='camel', kw_only=True):
+    # Only for users with nothing stored; retrieve_response builds the
+    # response for found documents
+    success: bool = True
+    chunks: list = []
+    metadata: list = []
+    documents_count: int = 0
+    message: str
+
+
+class ErrorResponse(msgspec.Struct, kw_only=True):
+    success: bool = False
+    error: str
+
+
+# Response structs have a fixed shape, so one encoder is built up front and
+# reused instead of walking a fresh dict on every request
+json_encoder = msgspec.json.Encoder()
+
+
+def json_response(payload):
+    """
+    Build a JSON response from one of the response structs
+    """
+    return Response(json_encoder.encode(payload), mimetype='application/json')
+
+
+def retrieve_response(chunks, metadata):
+    """
+    Build the success response without decoding and re-encoding the stored
+    metadata: each document's metadata.json bytes are spliced in as they are
+
+    Chunks are encoded once; their embedding rows are NumPy float32 arrays,
+    which orjson serializes natively.
+    """
+    # save_embeddings writes metadata with orjson, so a stored value that
+    # starts like a JSON object or array is spliced as is; anything else is
+    # round-tripped, which also rejects it if it is not valid JSON
+    metadata = [
+        content if bytes(content[:1]) in (b'{', b'[') else orjson.dumps(orjson.loads(content))
+        for content in metadata
+    ]
+    message = f'Retrieved {len(chunks)} chunks from {len(metadata)} documents'
+
+    body = b''.join([
+        b'{"success":true,"chunks":',
+        orjson.dumps(chunks, option=orjson.OPT_SERIALIZE_NUMPY),
+        b',"metadata":[',
+        b','.join(metadata),
+        b'],"documentsCount":',
+        str(len(metadata)).encode(),
+        b',"message":',
+        orjson.dumps(message),
+        b'}'
+    ])
+    return Response(body, mimetype='application/json')
+
 
 @functions_framework.http
 def retrieve_embeddings(request):
@@ -55,29 +320,25 @@ def retrieve_embeddings(request):
     }
 
     try:
-        request_json = request.get_json(silent=True)
+        # Parse the raw body with orjson rather than Flask's stdlib-based get_json
+        try:
+            request_json = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            request_json = None
 
-        if not request_json:
-            return (jsonify({'success': False, 'error': 'No JSON data provided'}), 400, headers)
+        if not request_json or not isinstance(request_json, dict):
+            return (json_response(ErrorResponse(error='No JSON data provided')), 400, headers)
 
         # Validate required fields
         if 'userId' not in request_json:
-            return (jsonify({'success': False, 'error': 'Missing required field: userId'}), 400, headers)
+            return (json_response(ErrorResponse(error='Missing required field: userId')), 400, headers)
 
         user_id = request_json['userId']
         document_id = request_json.get('documentId')  # Optional
 
-        bucket = storage_client.bucket(BUCKET_NAME)
-
-        if not bucket.exists():
+        if not check_bucket_exists(bucket):
             print(f'⚠️  Bucket {BUCKET_NAME} does not exist')
-            return (jsonify({
-                'success': True,
-                'chunks': [],
-                'metadata': [],
-                'documentsCount': 0,
-                'message': 'No documents found'
-            }), 200, headers)
+            return (json_response(EmptyRetrieveResponse(message='No documents found')), 200, headers)
 
         all_chunks = []
         all_metadata = []
@@ -86,27 +347,20 @@ def retrieve_embeddings(request):
             # Retrieve specific document
             print(f'📥 Retrieving document {document_id} for user {user_id}')
 
-            # Get chunks
-            chunks_blob_name = f'users/{user_id}/documents/{document_id}/chunks.json'
-            chunks_blob = bucket.blob(chunks_blob_name)
+            # Get chunks, embeddings and metadata in one concurrent round trip.
+            # A corrupt document raises and is reported as a 500 rather than
+            # as not found, since it still exists
+            prefix = f'users/{user_id}/documents/{document_id}/'
+            [(chunks, metadata)] = load_documents({
+                document_id: {file_name: bucket.blob(prefix + file_name) for file_name in DOCUMENT_FILES}
+            }, skip_corrupt=False)
 
-            if not chunks_blob.exists():
-                return (jsonify({
-                    'success': False,
-                    'error': f'Document {document_id} not found'
-                }), 404, headers)
+            if chunks is None:
+                return (json_response(ErrorResponse(error=f'Document {document_id} not found')), 404, headers)
 
-            chunks_data = chunks_blob.download_as_text()
-            chunks = json.loads(chunks_data)
             all_chunks.extend(chunks)
 
-            # Get metadata
-            metadata_blob_name = f'users/{user_id}/documents/{document_id}/metadata.json'
-            metadata_blob = bucket.blob(metadata_blob_name)
-
-            if metadata_blob.exists():
-                metadata_data = metadata_blob.download_as_text()
-                metadata = json.loads(metadata_data)
+            if metadata is not None:
                 all_metadata.append(metadata)
 
             print(f'✅ Retrieved {len(chunks)} chunks for document {document_id}')
@@ -116,47 +370,33 @@ def retrieve_embeddings(request):
             print(f'📥 Retrieving all documents for user {user_id}')
 
             prefix = f'users/{user_id}/documents/'
-            blobs = bucket.list_blobs(prefix=prefix)
+            blobs = bucket.list_blobs(prefix=prefix, fields=LIST_FIELDS)
 
             # Group blobs by document
             documents = {}
+            prefix_len = len(prefix)
             for blob in blobs:
-                # Parse path: users/{userId}/documents/{documentId}/{file}.json
-                parts = blob.name.split('/')
-                if len(parts) >= 5:
-                    doc_id = parts[3]
-                    file_type = parts[4]  # chunks.json or metadata.json
-
+                # Parse path: users/{userId}/documents/{documentId}/{file}, slicing
+                # off the known prefix instead of splitting the whole name
+                doc_id, _, file_type = blob.name[prefix_len:].partition('/')
+                if file_type:  # chunks.json, embeddings.bin or metadata.json
                     if doc_id not in documents:
                         documents[doc_id] = {}
 
                     documents[doc_id][file_type] = blob
 
-            # Retrieve all chunks and metadata
-            for doc_id, files in documents.items():
-                if 'chunks.json' in files:
-                    chunks_data = files['chunks.json'].download_as_text()
-                    chunks = json.loads(chunks_data)
+            # Retrieve all chunks, embeddings and metadata concurrently
+            for chunks, metadata in load_documents(documents):
+                if chunks is not None:
                     all_chunks.extend(chunks)
 
-                if 'metadata.json' in files:
-                    metadata_data = files['metadata.json'].download_as_text()
-                    metadata = json.loads(metadata_data)
+                if metadata is not None:
                     all_metadata.append(metadata)
 
             print(f'✅ Retrieved {len(all_chunks)} chunks from {len(documents)} documents')
 
-        return (jsonify({
-            'success': True,
-            'chunks': all_chunks,
-            'metadata': all_metadata,
-            'documentsCount': len(all_metadata),
-            'message': f'Retrieved {len(all_chunks)} chunks from {len(all_metadata)} documents'
-        }), 200, headers)
+        return (retrieve_response(all_chunks, all_metadata), 200, headers)
 
     except Exception as e:
         print(f'❌ Error retrieving embeddings: {str(e)}')
-        return (jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500, headers)
+        return (json_response(ErrorResponse(error=str(e))), 500, headers)
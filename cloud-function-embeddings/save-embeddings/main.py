@@ -1,11 +1,118 @@
 import functions_framework
 from google.cloud import storage
-import json
-from flask import jsonify
+import gzip
+import io
+import msgspec
+import numpy as np
+import orjson
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Response
+from requests.adapters import HTTPAdapter
 
 # Initialize Cloud Storage client
 storage_client = storage.Client()
 BUCKET_NAME = 'myformsnapper-embeddings'
+bucket = storage_client.bucket(BUCKET_NAME)
+
+# Size the connection pool for the concurrent transfers; requests keeps only
+# 10 connections per host by default
+HTTP_POOL_SIZE = 32
+storage_client._http.mount('https://', HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
+# Set once the bucket is known to exist; it is never deleted while deployed,
+# so warm instances skip the existence check after the first request
+bucket_exists = False
+bucket_exists_lock = threading.Lock()
+
+
+def check_bucket_exists(bucket):
+    """
+    Return whether the bucket exists, checking with Cloud Storage only until
+    it has been seen once on this instance
+    """
+    global bucket_exists
+
+    if not bucket_exists:
+        with bucket_exists_lock:
+            if not bucket_exists:
+                bucket_exists = bucket.exists()
+
+    return bucket_exists
+
+
+# Open a pooled HTTPS connection and fetch an access token while the instance
+# starts, so the first request does not pay for the TLS handshake
+try:
+    check_bucket_exists(bucket)
+except Exception as e:
+    print(f'⚠️  Storage warm-up failed: {str(e)}')
+
+# embeddings.bin starts with an 8-byte header: format version, 3 padding bytes, dimension
+EMBEDDINGS_HEADER = struct.Struct('<B3xI')
+EMBEDDINGS_FORMAT_INT8 = 1
+
+# One worker per file written for a document; reused across warm invocations
+executor = ThreadPoolExecutor(max_workers=3)
+
+
+def write_quantized_embeddings(embeddings, buffer):
+    """
+    Write a float32 embedding matrix to buffer as int8 rows with a float32
+    scale per row
+
+    Layout after the header: one little-endian float32 scale per row, then the
+    int8 rows, so a 768-dim vector takes 772 bytes instead of 3072
+    """
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(embeddings / scales[:, None]).astype(np.int8)
+
+    buffer.write(EMBEDDINGS_HEADER.pack(EMBEDDINGS_FORMAT_INT8, embeddings.shape[1]))
+    buffer.write(scales.astype('<f4'))
+    buffer.write(quantized)
+    buffer.seek(0)
+    return buffer
+
+
+def upload_buffer(blob, buffer):
+    """
+    Upload an in-memory buffer without copying it first
+    """
+    # A known size keeps uploads up to 8 MB to a single multipart request
+    # rather than a resumable session. It is taken by seeking, because
+    # getbuffer() on a BytesIO that wraps bytes copies the whole payload
+    size = buffer.seek(0, io.SEEK_END)
+    buffer.seek(0)
+    blob.upload_from_file(buffer, size=size)
+
+
+class SaveResponse(msgspec.Struct, rename='camel', kw_only=True):
+    success: bool = True
+    document_id: str
+    chunks_saved: int
+    storage_url: str
+    storage: str = 'cloud'
+    message: str
+
+
+class ErrorResponse(msgspec.Struct, kw_only=True):
+    success: bool = False
+    error: str
+
+
+# Response structs have a fixed shape, so one encoder is built up front and
+# reused instead of walking a fresh dict on every request
+json_encoder = msgspec.json.Encoder()
+
+
+def json_response(payload):
+    """
+    Build a JSON response from one of the response structs
+    """
+    return Response(json_encoder.encode(payload), mimetype='application/json')
+
 
 @functions_framework.http
 def save_embeddings(request):
@@ -59,16 +166,20 @@ def save_embeddings(request):
     }
 
     try:
-        request_json = request.get_json(silent=True)
+        # Parse the raw body with orjson rather than Flask's stdlib-based get_json
+        try:
+            request_json = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            request_json = None
 
-        if not request_json:
-            return (jsonify({'success': False, 'error': 'No JSON data provided'}), 400, headers)
+        if not request_json or not isinstance(request_json, dict):
+            return (json_response(ErrorResponse(error='No JSON data provided')), 400, headers)
 
         # Validate required fields
         required_fields = ['userId', 'documentId', 'fileName', 'chunks', 'metadata']
         for field in required_fields:
             if field not in request_json:
-                return (jsonify({'success': False, 'error': f'Missing required field: {field}'}), 400, headers)
+                return (json_response(ErrorResponse(error=f'Missing required field: {field}')), 400, headers)
 
         user_id = request_json['userId']
         document_id = request_json['documentId']
@@ -78,38 +189,61 @@ def save_embeddings(request):
 
         # Validate data types
         if not isinstance(chunks, list):
-            return (jsonify({'success': False, 'error': 'chunks must be an array'}), 400, headers)
+            return (json_response(ErrorResponse(error='chunks must be an array')), 400, headers)
 
         if len(chunks) == 0:
-            return (jsonify({'success': False, 'error': 'chunks array is empty'}), 400, headers)
+            return (json_response(ErrorResponse(error='chunks array is empty')), 400, headers)
+
+        # Embeddings are stored as one quantized matrix, so every chunk needs a
+        # non-empty vector of the same length. float32 conversion turns null
+        # into NaN and out-of-range values into inf, which cannot be quantized
+        try:
+            with np.errstate(over='ignore'):
+                embeddings = np.asarray([chunk['embedding'] for chunk in chunks], dtype=np.float32)
+        except (KeyError, TypeError, ValueError):
+            embeddings = None
+
+        if embeddings is None or embeddings.ndim != 2 or embeddings.shape[1] == 0 or not np.isfinite(embeddings).all():
+            return (json_response(ErrorResponse(error='Every chunk needs a non-empty embedding array of finite numbers of the same length')), 400, headers)
 
-        # Get or create bucket
+        # The vectors now live in the matrix; dropping them from the parsed chunks
+        # frees their Python floats before anything is serialized
+        for chunk in chunks:
+            del chunk['embedding']
+
+        # Create the bucket if needed
         try:
-            bucket = storage_client.bucket(BUCKET_NAME)
-            if not bucket.exists():
-                bucket = storage_client.create_bucket(BUCKET_NAME, location='us-central1')
+            if not check_bucket_exists(bucket):
+                storage_client.create_bucket(bucket, location='us-central1')
                 print(f'✅ Created bucket: {BUCKET_NAME}')
         except Exception as e:
             print(f'⚠️  Bucket access: {str(e)}')
-            bucket = storage_client.bucket(BUCKET_NAME)
 
-        # Save chunks to Cloud Storage
-        # Path: /users/{userId}/documents/{documentId}/chunks.json
+        # Save chunks, embeddings and metadata to Cloud Storage concurrently.
+        # chunks.json is stored with Content-Encoding: gzip at level 1, which
+        # keeps most of the size reduction for a fraction of the CPU time;
+        # the int8 embeddings and the small metadata do not compress usefully
+        # Path: /users/{userId}/documents/{documentId}/chunks.json      (chunks without embeddings, gzip-encoded)
+        # Path: /users/{userId}/documents/{documentId}/embeddings.bin   (int8 rows with per-row scales)
+        # Path: /users/{userId}/documents/{documentId}/metadata.json
         chunks_blob_name = f'users/{user_id}/documents/{document_id}/chunks.json'
         chunks_blob = bucket.blob(chunks_blob_name)
-        chunks_blob.upload_from_string(
-            json.dumps(chunks, indent=2),
-            content_type='application/json'
-        )
+        chunks_blob.content_type = 'application/json'
+        chunks_blob.content_encoding = 'gzip'
 
-        # Save metadata to Cloud Storage
-        # Path: /users/{userId}/documents/{documentId}/metadata.json
-        metadata_blob_name = f'users/{user_id}/documents/{document_id}/metadata.json'
-        metadata_blob = bucket.blob(metadata_blob_name)
-        metadata_blob.upload_from_string(
-            json.dumps(metadata, indent=2),
-            content_type='application/json'
-        )
+        embeddings_blob = bucket.blob(f'users/{user_id}/documents/{document_id}/embeddings.bin')
+        embeddings_blob.content_type = 'application/octet-stream'
+
+        metadata_blob = bucket.blob(f'users/{user_id}/documents/{document_id}/metadata.json')
+        metadata_blob.content_type = 'application/json'
+
+        # orjson and gzip return bytes, which BytesIO wraps without copying
+        uploads = [
+            (chunks_blob, io.BytesIO(gzip.compress(orjson.dumps(chunks), compresslevel=1))),
+            (embeddings_blob, write_quantized_embeddings(embeddings, io.BytesIO())),
+            (metadata_blob, io.BytesIO(orjson.dumps(metadata)))
+        ]
+        list(executor.map(lambda upload: upload_buffer(*upload), uploads))
 
         storage_url = f'gs://{BUCKET_NAME}/{chunks_blob_name}'
 
@@ -119,18 +253,13 @@ def save_embeddings(request):
         print(f'   Chunks: {len(chunks)}')
         print(f'   Storage URL: {storage_url}')
 
-        return (jsonify({
-            'success': True,
-            'documentId': document_id,
-            'chunksSaved': len(chunks),
-            'storageUrl': storage_url,
-            'storage': 'cloud',
-            'message': f'Successfully saved {len(chunks)} chunks for {file_name}'
-        }), 200, headers)
+        return (json_response(SaveResponse(
+            document_id=document_id,
+            chunks_saved=len(chunks),
+            storage_url=storage_url,
+            message=f'Successfully saved {len(chunks)} chunks for {file_name}'
+        )), 200, headers)
 
     except Exception as e:
         print(f'❌ Error saving embeddings: {str(e)}')
-        return (jsonify({
-            'success': False,
-            'error': str(e)
-        }), 500, headers)
+        return (json_response(ErrorResponse(error=str(e))), 500, headers)
@@ -4,8 +4,30 @@ Simple proxy that forwards requests to Toolhouse API
 """
 
 import functions_framework
+import msgspec
+import orjson
 import requests
-from flask import jsonify
+from flask import Response
+from requests.adapters import HTTPAdapter
+
+# Shared across warm invocations so requests reuse the open TLS connection to Toolhouse
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+
+class ErrorResponse(msgspec.Struct):
+    error: str
+
+
+json_encoder = msgspec.json.Encoder()
+
+
+def error_response(message):
+    """
+    Build a JSON error response, reusing one msgspec encoder
+    """
+    return Response(json_encoder.encode(ErrorResponse(message)), mimetype='application/json')
+
 
 @functions_framework.http
 def scrape_linkedin(request):
@@ -29,19 +51,24 @@ def scrape_linkedin(request):
 
     try:
         # Get request body (should have 'message' field)
-        request_json = request.get_json(silent=True)
+        request_body = request.get_data(cache=False)
+
+        try:
+            request_json = orjson.loads(request_body)
+        except orjson.JSONDecodeError:
+            request_json = None
 
         if not request_json:
-            return (jsonify({'error': 'No request body'}), 400, headers)
+            return (error_response('No request body'), 400, headers)
 
         print(f'📤 Forwarding to Toolhouse: {request_json}')
 
         # Forward EXACT request to Toolhouse
         toolhouse_url = 'https://agents.toolhouse.ai/7078fef9-081e-4f8c-b8ac-c816ef13c75f'
 
-        response = requests.post(
+        response = session.post(
             toolhouse_url,
-            json=request_json,
+            data=request_body,  # already valid JSON, so it is sent as received
             headers={'Content-Type': 'application/json'},
             timeout=60
         )
@@ -49,11 +76,11 @@ def scrape_linkedin(request):
         print(f'📥 Received from Toolhouse: {response.status_code}')
 
         if not response.ok:
-            return (jsonify({'error': f'Toolhouse error: {response.status_code}'}), 500, headers)
+            return (error_response(f'Toolhouse error: {response.status_code}'), 500, headers)
 
-        # Return EXACT response from Toolhouse
-        return (jsonify(response.json()), 200, headers)
+        # Return EXACT response from Toolhouse, forwarding the body bytes as received
+        return (Response(response.content, mimetype='application/json'), 200, headers)
 
     except Exception as e:
         print(f'❌ Error: {str(e)}')
-        return (jsonify({'error': str(e)}), 500, headers)
+        return (error_response(str(e)), 500, headers)